@@ -1,28 +1,138 @@
+import argparse
 import asyncio
+import functools
+import hashlib
+import itertools
 import json
 import sys
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, Callable, Mapping, Set
+from collections import OrderedDict
 from contextlib import AsyncExitStack
 
-from mcp import ClientSession, StdioServerParameters
+from mcp import ClientSession, StdioServerParameters, types
 from mcp.client.stdio import stdio_client
 
-import google.generativeai as genai
-from dotenv import load_dotenv
 import os
 
-load_dotenv()  # load environment variables from .env
+# Aggregator tool that servers may expose to run several tool calls in one request
+BATCH_TOOL_NAME = "batch_execute"
+
+# Property schema fields supported by Gemini function declarations
+_GEMINI_PROP_FIELDS = ("type", "description", "enum")
+
+# Maximum number of query responses kept in the client's response cache
+RESPONSE_CACHE_SIZE = 256
+
+
+def _as_dict(arguments: Mapping[str, Any]) -> Dict[str, Any]:
+    """Return tool arguments as a dict, copying only when they aren't one already"""
+    return arguments if isinstance(arguments, dict) else dict(arguments)
+
+
+def _content_to_text(content) -> str:
+    """Render one MCP content item as text"""
+    # MCP content types are a closed set, so an exact type check beats hasattr probing
+    if type(content) is types.TextContent:
+        return content.text
+    elif hasattr(content, 'data'):
+        return str(content.data)
+    else:
+        return str(content)
+
+
+def _chunk_text(chunk) -> str:
+    """Extract the text of a streamed response chunk, if any"""
+    if not chunk.candidates:
+        return ""
+    return "".join(
+        part.text for part in chunk.candidates[0].content.parts
+        if hasattr(part, 'text') and part.text
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _convert_tool(name: str, description: str, schema_json: str) -> Dict:
+    """Convert a single MCP tool to a Gemini function declaration
+    
+    The input schema is passed as a JSON string so results can be memoized
+    across queries, sessions and servers.
+    """
+    function_declaration = {
+        "name": name,
+        "description": description,
+        "parameters": {
+            "type": "object",
+            "properties": {},
+            "required": []
+        }
+    }
+    
+    # Convert input schema to Gemini format
+    schema = json.loads(schema_json)
+    if schema and isinstance(schema, dict):
+        # Clean properties by keeping only fields Gemini supports (drops e.g. 'title')
+        function_declaration["parameters"]["properties"] = {
+            prop_name: {
+                k: prop_schema[k] for k in _GEMINI_PROP_FIELDS
+                if isinstance(prop_schema, dict) and k in prop_schema
+            }
+            for prop_name, prop_schema in schema.get("properties", {}).items()
+        }
+        function_declaration["parameters"]["required"] = schema.get("required", [])
+    
+    return function_declaration
+
 
 class MCPClient:
     def __init__(self):
+        # Gemini SDK (grpc, protobuf, ...) is imported here rather than at module
+        # level so --help and usage errors don't pay for it
+        from google.generativeai.types import content_types
+        
         # Initialize session and client objects
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
         
-        # Configure Gemini
+        # Tool catalog fetched from the server; marked stale on tools/list_changed
+        self._tools: List = []
+        self._tools_stale = False
+        self._has_batch_tool = False
+        self._finalize_tools: Set[str] = set()
+        
+        # In-flight tool calls keyed by handle
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._call_ids = itertools.count(1)
+        
+        # Cached Gemini tool declarations and the catalog signature they were built from
+        self._gemini_tools: Optional[List[Dict]] = None
+        self._tools_sig: Optional[Tuple[Tuple[str, str, str], ...]] = None
+        
+        # LRU cache of final responses keyed by query and tool catalog
+        self._response_cache: "OrderedDict[str, str]" = OrderedDict()
+        
+        # SDK-ready forms of the tools and tool config, built once and reused per request
+        self._gemini_tools_pb: Optional["content_types.FunctionLibrary"] = None
+        self._tool_config_pb = content_types.to_tool_config(
+            {'function_calling_config': {'mode': 'AUTO'}}
+        )
+        
+        self.model = self._configure_gemini()
+
+    @staticmethod
+    def _configure_gemini():
+        """Load credentials, configure the Gemini SDK and return the model"""
+        import google.generativeai as genai
+        from dotenv import load_dotenv
+        
+        if os.path.exists('.env'):
+            load_dotenv('.env')  # load environment variables from .env
+        
         api_key = os.getenv('GEMINI_API_KEY')
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.0-flash-001')
+        # Stay on gRPC: the model lazily creates one async client whose HTTP/2
+        # channel is kept alive and reused by every request. The REST transport
+        # has no async support in this SDK.
+        genai.configure(api_key=api_key, transport="grpc")
+        return genai.GenerativeModel('gemini-2.0-flash-001')
 
     async def connect_to_server(self, server_script_path: str):
         """Connect to an MCP server
@@ -39,149 +149,304 @@ class MCPClient:
         server_params = StdioServerParameters(
             command=command,
             args=[server_script_path],
-            env=None
+            # Keep the child's stdout unbuffered so responses aren't held back
+            env={**os.environ, "PYTHONUNBUFFERED": "1"}
         )
         
+        await self._ensure_connected(server_params)
+        
+        # List available tools
+        tools = await self.refresh_tools()
+        print("\nConnected to server with tools:", [tool.name for tool in tools])
+
+    async def _ensure_connected(self, server_params: StdioServerParameters):
+        """Spawn the server and open a session, at most once per connection
+        
+        The stdio transport is meant to live for the whole session; respawning
+        the server per call would destroy throughput, so a second connect
+        without an intervening disconnect() is an error.
+        """
+        if self.session is not None:
+            raise RuntimeError("Already connected to a server; call disconnect() first")
+        
         stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
         self.stdio, self.write = stdio_transport
-        self.session = await self.exit_stack.enter_async_context(ClientSession(self.stdio, self.write))
+        self.session = await self.exit_stack.enter_async_context(
+            ClientSession(self.stdio, self.write, message_handler=self._handle_message)
+        )
         
         await self.session.initialize()
-        
-        # List available tools
+
+    async def refresh_tools(self) -> List:
+        """Fetch the tool catalog from the server and rebuild the Gemini tools"""
         response = await self.session.list_tools()
-        tools = response.tools
-        print("\nConnected to server with tools:", [tool.name for tool in tools])
+        self._tools = response.tools
+        self._tools_stale = False
+        self._has_batch_tool = any(tool.name == BATCH_TOOL_NAME for tool in self._tools)
+        
+        # Tools annotated with finalize=True return answers that need no follow-up from Gemini
+        self._finalize_tools = {
+            tool.name for tool in self._tools
+            if getattr(getattr(tool, 'annotations', None), 'finalize', False) is True
+        }
+        
+        # Warm the Gemini tool cache so queries don't pay for conversion
+        self.get_gemini_tools(self._tools)
+        return self._tools
+
+    async def _handle_message(self, message) -> None:
+        """Handle incoming server messages, tracking tool catalog changes"""
+        # Only flag the catalog here: issuing list_tools from inside the
+        # session's receive loop would wait on a response it can't read
+        if isinstance(message, types.ServerNotification) and isinstance(
+            message.root, types.ToolListChangedNotification
+        ):
+            self._tools_stale = True
 
     def convert_mcp_tools_to_gemini(self, mcp_tools: List) -> List[Dict]:
         """Convert MCP tools to Gemini function calling format"""
-        gemini_tools = []
-        
-        for tool in mcp_tools:
-            function_declaration = {
-                "name": tool.name,
-                "description": tool.description,
-                "parameters": {
-                    "type": "object",
-                    "properties": {},
-                    "required": []
-                }
-            }
-            
-            # Convert input schema to Gemini format
-            if hasattr(tool, 'inputSchema') and tool.inputSchema:
-                schema = tool.inputSchema
-                if isinstance(schema, dict):
-                    if "properties" in schema:
-                        # Clean properties by removing unsupported fields
-                        cleaned_properties = {}
-                        for prop_name, prop_schema in schema["properties"].items():
-                            cleaned_prop = {}
-                            if isinstance(prop_schema, dict):
-                                # Only keep supported fields for Gemini
-                                if "type" in prop_schema:
-                                    cleaned_prop["type"] = prop_schema["type"]
-                                if "description" in prop_schema:
-                                    cleaned_prop["description"] = prop_schema["description"]
-                                if "enum" in prop_schema:
-                                    cleaned_prop["enum"] = prop_schema["enum"]
-                                # Remove unsupported fields like 'title'
-                            cleaned_properties[prop_name] = cleaned_prop
-                        
-                        function_declaration["parameters"]["properties"] = cleaned_properties
-                    
-                    if "required" in schema:
-                        function_declaration["parameters"]["required"] = schema["required"]
-            
-            gemini_tools.append({"function_declarations": [function_declaration]})
+        function_declarations = [
+            _convert_tool(name, description, schema_json)
+            for name, description, schema_json in self._tools_signature(mcp_tools)
+        ]
         
-        return gemini_tools
+        # Gemini accepts many declarations in one Tool, so send a single wrapper
+        return [{"function_declarations": function_declarations}] if function_declarations else []
+
+    def _tools_signature(self, mcp_tools: List) -> Tuple[Tuple[str, str, str], ...]:
+        """Build a hashable signature identifying a tool catalog"""
+        return tuple(
+            (
+                tool.name,
+                tool.description,
+                json.dumps(getattr(tool, 'inputSchema', None), sort_keys=True)
+            )
+            for tool in mcp_tools
+        )
+
+    def get_gemini_tools(self, mcp_tools: List) -> List[Dict]:
+        """Return Gemini tools for the catalog, rebuilding only when it changes"""
+        tools_sig = self._tools_signature(mcp_tools)
+        if self._gemini_tools is None or tools_sig != self._tools_sig:
+            from google.generativeai.types import content_types
+            
+            self._gemini_tools = self.convert_mcp_tools_to_gemini(mcp_tools)
+            self._gemini_tools_pb = (
+                content_types.to_function_library(self._gemini_tools) if self._gemini_tools else None
+            )
+            self._tools_sig = tools_sig
+        return self._gemini_tools
 
-    async def execute_tool_call(self, tool_name: str, arguments: Dict[str, Any]) -> str:
+    async def execute_tool_call(self, tool_name: str, arguments: Mapping[str, Any]) -> str:
         """Execute a tool call via MCP"""
+        arguments = _as_dict(arguments)
+        print(f"\nExecuting tool: {tool_name} with arguments: {arguments}")
         try:
             result = await self.session.call_tool(tool_name, arguments)
-            
-            if result.content:
-                # Handle different content types
-                content_parts = []
-                for content in result.content:
-                    if hasattr(content, 'text'):
-                        content_parts.append(content.text)
-                    elif hasattr(content, 'data'):
-                        content_parts.append(str(content.data))
-                    else:
-                        content_parts.append(str(content))
-                
-                return "\n".join(content_parts)
-            else:
-                return "Tool executed successfully but returned no content"
+            return self._format_tool_result(result)
                 
         except Exception as e:
             return f"Error executing tool {tool_name}: {str(e)}"
 
-    async def process_query(self, query: str) -> str:
-        """Process a query using Gemini and available tools"""
+    def _format_tool_result(self, result) -> str:
+        """Flatten the content of an MCP tool result into text"""
+        if result.content:
+            return "\n".join(_content_to_text(content) for content in result.content)
+        else:
+            return "Tool executed successfully but returned no content"
+
+    def _dispatch_tool_call(self, tool_name: str, arguments: Mapping[str, Any]) -> str:
+        """Start a tool call in the background and return a handle to its result"""
+        handle = f"call_{next(self._call_ids)}"
+        self._pending[handle] = asyncio.create_task(self.execute_tool_call(tool_name, arguments))
+        return handle
+
+    async def _resolve_tool_call(self, handle: str) -> str:
+        """Wait for a dispatched tool call to finish and return its result"""
+        task = self._pending[handle]
+        result = await task
+        del self._pending[handle]
+        return result
+
+    async def execute_tool_calls_batch(self, calls: List[Tuple[str, Mapping[str, Any]]]) -> List[str]:
+        """Execute several tool calls, in one round-trip when the server supports it
         
-        # Get available tools
-        response = await self.session.list_tools()
-        available_tools = response.tools
+        Args:
+            calls: (tool_name, arguments) pairs
+        
+        Returns:
+            Tool results in the same order as calls
+        """
+        if self._has_batch_tool and len(calls) > 1:
+            calls = [(tool_name, _as_dict(arguments)) for tool_name, arguments in calls]
+            operations = [
+                {"tool": tool_name, "arguments": arguments}
+                for tool_name, arguments in calls
+            ]
+            print(f"\nExecuting tools in batch: {operations}")
+            try:
+                result = await self.session.call_tool(
+                    BATCH_TOOL_NAME,
+                    {"operations": operations, "maxConcurrent": len(operations)}
+                )
+                results = self._parse_batch_result(result, calls)
+                if results is not None:
+                    return results
+            except Exception as e:
+                print(f"\nBatch execution failed, falling back to individual calls: {e}")
+        
+        return list(await asyncio.gather(
+            *(self.execute_tool_call(tool_name, arguments) for tool_name, arguments in calls)
+        ))
+
+    def _parse_batch_result(self, result, calls: List[Tuple[str, Mapping[str, Any]]]) -> Optional[List[str]]:
+        """Split a batch_execute result into per-call results, or None if it can't be matched up"""
+        if getattr(result, 'isError', False):
+            return None
+        try:
+            entries = json.loads(self._format_tool_result(result))
+        except (TypeError, ValueError):
+            return None
+        if isinstance(entries, dict):
+            entries = entries.get("results")
+        if not isinstance(entries, list) or len(entries) != len(calls):
+            return None
+        
+        results = []
+        for (tool_name, _), entry in zip(calls, entries):
+            if isinstance(entry, dict) and entry.get("error"):
+                results.append(f"Error executing tool {tool_name}: {entry['error']}")
+                continue
+            if isinstance(entry, dict) and "result" in entry:
+                entry = entry["result"]
+            results.append(entry if isinstance(entry, str) else json.dumps(entry))
+        return results
+
+    def _response_cache_key(self, query: str) -> str:
+        """Key a query by its text and the tool catalog it was answered with"""
+        return hashlib.blake2b((query + repr(self._tools_sig)).encode()).hexdigest()
+
+    def _cache_response(self, cache_key: str, response_text: str):
+        """Store a response, evicting the least recently used entry when full"""
+        self._response_cache[cache_key] = response_text
+        self._response_cache.move_to_end(cache_key)
+        if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
+
+    async def process_query(self, query: str, on_text: Optional[Callable[[str], None]] = None) -> str:
+        """Process a query using Gemini and available tools
         
-        # Convert tools to Gemini format
-        gemini_tools = self.convert_mcp_tools_to_gemini(available_tools)
+        Args:
+            query: The user's query
+            on_text: Optional callback receiving the tool follow-up response as it streams in
+        
+        Returns:
+            The complete response text
+        """
+        
+        # Get available tools, refetching only if the server reported a change.
+        # refresh_tools() converts the catalog, so the Gemini tools are just read here.
+        if self._tools_stale:
+            await self.refresh_tools()
+        gemini_tools = self._gemini_tools
+        
+        # Serve repeated queries against the same catalog from the cache
+        cache_key = self._response_cache_key(query)
+        cached_response = self._response_cache.get(cache_key)
+        if cached_response is not None:
+            self._response_cache.move_to_end(cache_key)
+            return cached_response
+        
+        # Tool calls started for this query, so they can be cancelled on failure
+        handles: List[str] = []
         
         try:
-            # Initial request to Gemini
+            # Initial request to Gemini, streamed so tools can start before decoding finishes
+            request_kwargs = {}
             if gemini_tools:
-                response = self.model.generate_content(
-                    query,
-                    tools=gemini_tools,
-                    tool_config={'function_calling_config': {'mode': 'AUTO'}}
-                )
-            else:
-                response = self.model.generate_content(query)
+                request_kwargs = {
+                    "tools": self._gemini_tools_pb,
+                    "tool_config": self._tool_config_pb
+                }
+            response = await self.model.generate_content_async(query, stream=True, **request_kwargs)
             
-            # Check if Gemini wants to call functions
-            if response.candidates and response.candidates[0].content.parts:
-                parts = response.candidates[0].content.parts
-                
-                final_response_parts = []
-                
-                for part in parts:
+            function_call_parts = []
+            calls = []
+            async for chunk in response:
+                chunk_parts = chunk.candidates[0].content.parts if chunk.candidates else []
+                for part in chunk_parts:
                     if hasattr(part, 'function_call') and part.function_call:
-                        # Execute the function call
                         function_call = part.function_call
-                        tool_name = function_call.name
                         
-                        # Convert arguments
+                        # Pass the args mapping through; it is copied once at the MCP boundary
                         arguments = {}
                         if hasattr(function_call, 'args') and function_call.args:
-                            arguments = dict(function_call.args)
-                        
-                        print(f"\nExecuting tool: {tool_name} with arguments: {arguments}")
+                            arguments = function_call.args
                         
-                        # Execute the tool
-                        tool_result = await self.execute_tool_call(tool_name, arguments)
+                        function_call_parts.append(part)
+                        calls.append((function_call.name, arguments))
                         
-                        # Create a follow-up request with the tool result
-                        follow_up_messages = [
-                            {"role": "user", "parts": [{"text": query}]},
-                            {"role": "model", "parts": [{"function_call": function_call}]},
-                            {"role": "user", "parts": [{"function_response": {
-                                "name": tool_name,
+                        # Batch-capable servers get all calls at once after the stream ends
+                        if not self._has_batch_tool:
+                            handles.append(self._dispatch_tool_call(function_call.name, arguments))
+            
+            # Check if Gemini wants to call functions
+            if response.candidates and response.candidates[0].content.parts:
+                parts = response.candidates[0].content.parts
+                
+                final_response_parts = [
+                    part.text for part in parts
+                    if not (hasattr(part, 'function_call') and part.function_call)
+                    and hasattr(part, 'text') and part.text
+                ]
+                
+                if function_call_parts:
+                    # Collect results of the tools started while Gemini was decoding
+                    if handles:
+                        tool_results = [await self._resolve_tool_call(handle) for handle in handles]
+                    else:
+                        tool_results = await self.execute_tool_calls_batch(calls)
+                    
+                    # A lone call to a finalizing tool already is the answer; skip the follow-up decode
+                    if len(calls) == 1 and not final_response_parts and calls[0][0] in self._finalize_tools:
+                        return tool_results[0]
+                    
+                    # Create a single follow-up request with all tool results
+                    follow_up_messages = [
+                        {"role": "user", "parts": [{"text": query}]},
+                        {"role": "model", "parts": [
+                            {"function_call": part.function_call} for part in function_call_parts
+                        ]},
+                        {"role": "user", "parts": [
+                            {"function_response": {
+                                "name": name,
                                 "response": {"result": tool_result}
-                            }}]}
-                        ]
-                        
-                        # Get final response from Gemini
-                        final_response = self.model.generate_content(follow_up_messages)
-                        if final_response.text:
-                            final_response_parts.append(final_response.text)
-                        
-                    elif hasattr(part, 'text') and part.text:
-                        final_response_parts.append(part.text)
+                            }}
+                            for (name, _), tool_result in zip(calls, tool_results)
+                        ]}
+                    ]
+                    
+                    # Surface any text that preceded the tool calls before streaming the answer
+                    if on_text is not None and final_response_parts:
+                        on_text("\n".join(final_response_parts) + "\n")
+                    
+                    # Get final response from Gemini, streamed so output starts at the first token
+                    final_response = await self.model.generate_content_async(follow_up_messages, stream=True)
+                    async for chunk in final_response:
+                        chunk_text = _chunk_text(chunk)
+                        if on_text is not None and chunk_text:
+                            on_text(chunk_text)
+                    if final_response.text:
+                        final_response_parts.append(final_response.text)
+                
+                if not final_response_parts:
+                    return "No response generated"
                 
-                return "\n".join(final_response_parts) if final_response_parts else "No response generated"
+                final_text = "\n".join(final_response_parts)
+                # Answers built from tool results reflect live server state, so only cache plain replies
+                if not function_call_parts:
+                    self._cache_response(cache_key, final_text)
+                return final_text
             
             # If no function calls, return the text response
             return response.text if response.text else "No response generated"
@@ -189,6 +454,31 @@ class MCPClient:
         except Exception as e:
             print(f"Error calling Gemini API: {e}")
             return f"Error: {str(e)}"
+        finally:
+            for handle in handles:
+                task = self._pending.pop(handle, None)
+                if task is not None:
+                    task.cancel()
+
+    async def run_batch(self, queries: List[str], concurrency: int = 8) -> List[str]:
+        """Process several queries concurrently
+        
+        Args:
+            queries: Queries to answer
+            concurrency: Maximum number of queries in flight at once
+        
+        Returns:
+            Responses in the same order as queries
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def bounded(query: str) -> str:
+            async with semaphore:
+                return await self.process_query(query)
+        
+        return list(await asyncio.gather(*(bounded(query) for query in queries)))
 
     async def chat_loop(self):
         """Run an interactive chat loop"""
@@ -197,32 +487,77 @@ class MCPClient:
         
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                # Read input off the event loop so MCP traffic keeps flowing while we wait
+                query = (await asyncio.to_thread(input, "\nQuery: ")).strip()
                 
                 if query.lower() == 'quit':
                     break
                     
-                response = await self.process_query(query)
-                print(f"\nResponse: {response}")
+                streamed = False
+                
+                def print_chunk(text: str):
+                    nonlocal streamed
+                    if not streamed:
+                        print("\nResponse: ", end="")
+                        streamed = True
+                    print(text, end="", flush=True)
+                
+                response = await self.process_query(query, on_text=print_chunk)
+                if streamed:
+                    print()
+                else:
+                    print(f"\nResponse: {response}")
                     
             except Exception as e:
                 print(f"\nError: {str(e)}")
     
+    async def disconnect(self):
+        """Close the server session and transport so the client can reconnect"""
+        await self.exit_stack.aclose()
+        self.exit_stack = AsyncExitStack()
+        self.session = None
+        self._tools = []
+        self._tools_stale = False
+        self._has_batch_tool = False
+        self._finalize_tools = set()
+
     async def cleanup(self):
         """Clean up resources"""
-        await self.exit_stack.aclose()
+        await self.disconnect()
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="MCP client powered by Google Gemini")
+    parser.add_argument("server_script", help="Path to the MCP server script (.py or .js)")
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="Answer the queries in FILE (one per line) concurrently instead of starting a chat"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of batch queries in flight at once (default: 8)"
+    )
+    return parser.parse_args(argv)
 
 async def main():
-    if len(sys.argv) < 2:
-        print("Usage: python client.py <path_to_server_script>")
-        sys.exit(1)
+    args = parse_args(sys.argv[1:])
         
     client = MCPClient()
     try:
-        await client.connect_to_server(sys.argv[1])
-        await client.chat_loop()
+        await client.connect_to_server(args.server_script)
+        if args.batch:
+            with open(args.batch) as f:
+                queries = [line.strip() for line in f if line.strip()]
+            responses = await client.run_batch(queries, concurrency=args.concurrency)
+            for query, response in zip(queries, responses):
+                print(f"\nQuery: {query}\nResponse: {response}")
+        else:
+            await client.chat_loop()
     finally:
         await client.cleanup()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())